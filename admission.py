@@ -0,0 +1,267 @@
+from flask import Response, request, session, g
+from collections import OrderedDict
+from math import ceil
+import threading
+import time
+import json
+import config
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# HTTP methods that change state, these get priority over polling reads
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# endpoints that get priority regardless of method
+PRIORITY_ENDPOINTS = ('login',)
+
+# token bucket in redis, refill and take in one atomic step.  the clock
+# is redis' own, so app hosts don't need to agree on the time
+TOKEN_BUCKET_LUA = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil then
+    tokens = burst
+    ts = now
+end
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+
+class MemoryRateLimiter(object):
+    """
+    Per-process token bucket rate limiter
+    :param rate: tokens added per second
+    :param burst: bucket size
+    """
+
+    # hard cap on tracked keys, the least recently used are evicted
+    max_keys = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        # key -> (tokens, ts), least recently used first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key):
+        """
+        Take a token from the bucket for key
+        :param key: str
+        :return: tuple (allowed, seconds until a token is available)
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, ts = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - ts) * self.rate)
+
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                allowed, wait = True, 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed, wait = False, (1 - tokens) / self.rate
+            self._buckets.move_to_end(key)
+
+            self._prune(now)
+
+        return allowed, wait
+
+    def _prune(self, now):
+        # a bucket idle long enough to refill is the same as no bucket.
+        # only the oldest entries are looked at, so this is amortized O(1)
+        idle = self.burst / self.rate
+        while self._buckets:
+            key, (tokens, ts) = next(iter(self._buckets.items()))
+            if now - ts < idle and len(self._buckets) <= self.max_keys:
+                break
+            self._buckets.popitem(last=False)
+
+
+class RedisRateLimiter(object):
+    """
+    Token bucket rate limiter shared by all processes through redis
+    :param url: redis connection url
+    :param rate: tokens added per second
+    :param burst: bucket size
+    :param timeout: socket timeout in seconds
+    """
+
+    key_prefix = 'tasker:admission:'
+
+    def __init__(self, url, rate, burst, timeout):
+        if redis is None:
+            raise RuntimeError('The redis package is required for ADMISSION_REDIS_URL.')
+        self.rate = float(rate)
+        self.burst = float(burst)
+        # a slow redis must fail open quickly, not hold up every request
+        self._redis = redis.StrictRedis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._script = self._redis.register_script(TOKEN_BUCKET_LUA)
+
+    def consume(self, key):
+        """
+        Take a token from the bucket for key
+        :param key: str
+        :return: tuple (allowed, seconds until a token is available)
+        """
+        try:
+            allowed, wait = self._script(
+                keys=[self.key_prefix + str(key)],
+                args=[self.rate, self.burst]
+            )
+        except redis.RedisError:
+            # fail open, an outage in the limiter should not take down the api
+            return True, 0.0
+
+        return bool(allowed), float(wait)
+
+
+class ConcurrencyGate(object):
+    """
+    Bounded count of in-flight DB-bound requests.  Priority requests
+    are admitted first and may use the reserved slots.
+    :param capacity: max concurrent requests
+    :param reserved: slots only priority requests may take
+    """
+
+    def __init__(self, capacity, reserved=0):
+        self.capacity = capacity
+        self.reserved = min(reserved, capacity - 1)
+        self.in_use = 0
+        self._priority_waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, priority, timeout):
+        """
+        Wait up to timeout seconds for a slot
+        :param priority: bool
+        :param timeout: float seconds
+        :return: True if a slot was taken
+        """
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            if priority:
+                self._priority_waiting += 1
+            try:
+                while not self._can_enter(priority):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.in_use += 1
+                return True
+            finally:
+                if priority:
+                    self._priority_waiting -= 1
+                    # reads held back by this request may be able to go now
+                    self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify_all()
+
+    def _can_enter(self, priority):
+        if priority:
+            return self.in_use < self.capacity
+        return self._priority_waiting == 0 and self.in_use < self.capacity - self.reserved
+
+
+class AdmissionControl(object):
+    """
+    Admission control for the api.  Rate limits each user and caps the
+    number of requests holding a DB connection, shedding load with a
+    fast 429 or 503 instead of queueing on the connection pool.
+    :param app: Flask app
+    """
+
+    def __init__(self, app=None):
+        self.limiter = None
+        self.gate = None
+        self.queue_deadline = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if config.ADMISSION_REDIS_URL:
+            self.limiter = RedisRateLimiter(config.ADMISSION_REDIS_URL, config.ADMISSION_RATE,
+                                            config.ADMISSION_BURST, config.ADMISSION_REDIS_TIMEOUT)
+        else:
+            self.limiter = MemoryRateLimiter(config.ADMISSION_RATE, config.ADMISSION_BURST)
+
+        # the pool is per process, so the gate is too
+        self.gate = ConcurrencyGate(config.ADMISSION_MAX_CONCURRENT, config.ADMISSION_RESERVED_SLOTS)
+        self.queue_deadline = config.ADMISSION_QUEUE_DEADLINE
+
+        # teardown_appcontext handlers run in reverse order, so this must be
+        # registered before the one that removes the db session.  the slot
+        # is then only freed once its connection is back in the pool
+        app.before_request(self.before_request)
+        app.teardown_appcontext(self.teardown_appcontext)
+
+    def before_request(self):
+        """
+        Rate limit, then wait for a slot
+        :return: None, or a 429/503 response
+        """
+        if request.endpoint is None or request.endpoint == 'static':
+            return None
+
+        allowed, wait = self.limiter.consume(self._client_key())
+        if not allowed:
+            return self._reject(429, 'Rate limit exceeded.  Slow down!', wait)
+
+        if not self.gate.acquire(self._is_priority(), self.queue_deadline):
+            return self._reject(503, 'Server busy.  Please try again shortly.', self.queue_deadline)
+
+        g.admission_slot = True
+        return None
+
+    def teardown_appcontext(self, exception=None):
+        if g.pop('admission_slot', False):
+            self.gate.release()
+
+    @staticmethod
+    def _client_key():
+        # read the user id from the session, current_user would hit the db
+        user_id = session.get('user_id') or session.get('_user_id')
+        if user_id is not None:
+            return 'user:{}'.format(user_id)
+        return 'addr:{}'.format(request.remote_addr)
+
+    @staticmethod
+    def _is_priority():
+        return request.method in WRITE_METHODS or request.endpoint in PRIORITY_ENDPOINTS
+
+    @staticmethod
+    def _reject(status, data, retry_after):
+        resp = Response(
+            response=json.dumps(data),
+            status=status,
+            mimetype='application/json'
+        )
+        resp.headers['Retry-After'] = str(max(1, int(ceil(retry_after))))
+        return resp
@@ -5,8 +5,10 @@ from flask_restful import Api, Resource, reqparse, fields, marshal
 from flask_login import LoginManager, login_required, login_user, logout_user, current_user
 from sqlalchemy import exc
 from celery import Celery
-from database import db_session
+from database import db_session, engine
 from models import Task, TaskType, User
+from admission import AdmissionControl
+from login_events import LoginEventBuffer
 from flask_mail import Mail, Message
 from datetime import datetime
 import uuid
@@ -26,6 +28,10 @@ login_manager.login_message_category = "primary"
 # api wrapper
 api = Api(app)
 
+# rate limits and load shedding in front of the db pool, keep this
+# above shutdown_session so slots are freed after the session is removed
+admission = AdmissionControl(app)
+
 # top secret stuff
 app.config['SECRET_KEY'] = config.SECRET_KEY
 
@@ -45,6 +51,9 @@ celery.conf.update(app.config)
 # config mail
 mail = Mail(app)
 
+# login bookkeeping, flushed to the users table in the background
+login_events = LoginEventBuffer(engine)
+
 
 # clear all db sessions at the end of each request
 @app.teardown_appcontext
@@ -434,13 +443,21 @@ class UserLoginAPI(Resource):
         :return: login
         """
         data = self.reqparse.parse_args()
+        invalid = {'message': 'Invalid login credentials...'}
+
+        # locked out names get the same answer as a bad login, whether or not they exist
+        if login_events.is_locked_out(data['username']):
+            return invalid
+
         user = db_session.query(User).filter_by(username=data['username']).first()
 
         if not user or not user.check_password(data['password']):
-            return {'message': 'Invalid login credentials...'.format(data['username'])}
+            login_events.record_failure(data['username'], user.id if user else None)
+            return invalid
 
         # login the user
         login_user(user)
+        login_events.record_success(data['username'], user.id)
         return {
             'current_user': g.user.username,
             'logged_in': True,
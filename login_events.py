@@ -0,0 +1,258 @@
+from sqlalchemy import exc, case, func
+from models import User
+from datetime import datetime
+import threading
+import traceback
+import atexit
+import time
+import os
+import config
+
+
+class LoginEventBuffer(object):
+    """
+    Write-behind buffer for the login bookkeeping columns on User.
+    Login successes and failures are collected in memory and written
+    as one aggregated UPDATE per batch, off the login request path.
+    Also answers account lockout checks from memory.
+    :param engine: SQLAlchemy engine
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.flush_interval = config.LOGIN_FLUSH_INTERVAL
+        self.flush_threshold = config.LOGIN_FLUSH_THRESHOLD
+        self.batch_size = config.LOGIN_FLUSH_BATCH_SIZE
+        self.max_backoff = config.LOGIN_FLUSH_MAX_BACKOFF
+        self.max_pending = config.LOGIN_MAX_PENDING
+        self.max_failures = config.LOGIN_MAX_FAILURES
+        self.lockout_seconds = config.LOGIN_LOCKOUT_SECONDS
+
+        # user_id -> pending column changes, swapped out on each flush
+        self._pending = {}
+        # username -> (consecutive failures, monotonic time of the last one)
+        self._failures = {}
+        # events dropped because the buffer was full, and failed flushes in a row
+        self._dropped = 0
+        self._flush_failures = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        atexit.register(self.stop)
+
+    def record_success(self, username, user_id):
+        """
+        Buffer a successful login
+        :param username: str
+        :param user_id: int
+        :return: None
+        """
+        with self._lock:
+            self._check_pid()
+            entry = self._entry(user_id)
+            if entry is not None:
+                entry['logins'] += 1
+                entry['failures'] = 0
+                entry['reset'] = True
+                entry['last_login'] = datetime.now()
+            self._failures.pop(normalize_username(username), None)
+            self._check_size()
+
+    def record_failure(self, username, user_id=None):
+        """
+        Buffer a failed login.  Unknown usernames are counted too, so
+        a lockout doesn't reveal which accounts exist.
+        :param username: str
+        :param user_id: int, or None if no such user
+        :return: None
+        """
+        with self._lock:
+            self._check_pid()
+            entry = self._entry(user_id) if user_id is not None else None
+            if entry is not None:
+                entry['failures'] += 1
+            key = normalize_username(username)
+            count, _ = self._failures.get(key, (0, None))
+            self._failures[key] = (count + 1, time.monotonic())
+            self._check_size()
+
+    def is_locked_out(self, username):
+        """
+        Has the username failed too many logins in a row, recently
+        :param username: str
+        :return: bool
+        """
+        key = normalize_username(username)
+        with self._lock:
+            self._check_pid()
+            count, last = self._failures.get(key, (0, None))
+            if count < self.max_failures:
+                return False
+            if time.monotonic() - last >= self.lockout_seconds:
+                # lockout expired, start counting again
+                del self._failures[key]
+                return False
+            return True
+
+    def flush(self):
+        """
+        Write all buffered events to the database
+        :return: number of users updated
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._check_pid()
+                pending, self._pending = self._pending, {}
+                dropped, self._dropped = self._dropped, 0
+                self._prune_failures()
+
+            if dropped:
+                print('login bookkeeping buffer full, dropped {} events'.format(dropped))
+
+            user_ids = list(pending)
+            for i in range(0, len(user_ids), self.batch_size):
+                batch = {user_id: pending[user_id] for user_id in user_ids[i:i + self.batch_size]}
+                try:
+                    self._write(batch)
+                except Exception as err:
+                    self._flush_failures += 1
+                    # put the unwritten events back for the next flush
+                    with self._lock:
+                        for user_id in user_ids[i:]:
+                            self._requeue(user_id, pending[user_id])
+                    if not isinstance(err, exc.SQLAlchemyError):
+                        raise
+                    print(str(err))
+                    return i
+
+            self._flush_failures = 0
+            return len(user_ids)
+
+    def stop(self):
+        """
+        Stop the flush thread and drain the buffer
+        :return: None
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.flush_interval)
+        self.flush()
+
+    def _write(self, batch):
+        """
+        One set-based UPDATE for a batch of users
+        :param batch: dict user_id -> entry
+        """
+        table = User.__table__
+        login_count = {}
+        last_login = {}
+        fail_count = {}
+        for user_id, e in batch.items():
+            if e['logins']:
+                login_count[user_id] = func.coalesce(table.c.login_count, 0) + e['logins']
+                last_login[user_id] = e['last_login']
+            # a success in the batch resets the count to the failures after it
+            if e['reset']:
+                fail_count[user_id] = e['failures']
+            elif e['failures']:
+                fail_count[user_id] = func.coalesce(table.c.fail_login_count, 0) + e['failures']
+
+        # rows without a WHEN keep their current value
+        values = {}
+        if login_count:
+            values['login_count'] = case(login_count, value=table.c.id, else_=table.c.login_count)
+            values['last_login'] = case(last_login, value=table.c.id, else_=table.c.last_login)
+        if fail_count:
+            values['fail_login_count'] = case(fail_count, value=table.c.id, else_=table.c.fail_login_count)
+
+        with self.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.id.in_(list(batch))).values(**values))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                break
+            try:
+                self.flush()
+            except Exception:
+                # keep the thread alive, the events were requeued
+                traceback.print_exc()
+
+            if self._flush_failures:
+                # back off while the db is down, a full buffer can't cut this short
+                delay = min(self.flush_interval * 2 ** (self._flush_failures - 1), self.max_backoff)
+                self._stopping.wait(delay)
+                continue
+
+            # events buffered during the flush may already be over the threshold
+            with self._lock:
+                self._check_size()
+
+    def _entry(self, user_id):
+        # None once the buffer is full, the event is dropped
+        entry = self._pending.get(user_id)
+        if entry is None:
+            if len(self._pending) >= self.max_pending:
+                self._dropped += 1
+                return None
+            entry = self._pending[user_id] = {'logins': 0, 'failures': 0, 'reset': False, 'last_login': None}
+        return entry
+
+    def _requeue(self, user_id, old):
+        # merge older, unwritten events in front of anything buffered since
+        new = self._pending.get(user_id)
+        if new is None:
+            if len(self._pending) >= self.max_pending:
+                self._dropped += 1
+            else:
+                self._pending[user_id] = old
+            return
+        new['logins'] += old['logins']
+        if not new['reset']:
+            new['failures'] += old['failures']
+            new['reset'] = old['reset']
+            new['last_login'] = old['last_login']
+
+    def _check_size(self):
+        if len(self._pending) >= self.flush_threshold:
+            self._wakeup.set()
+
+    def _prune_failures(self):
+        # forget failure streaks that can no longer cause a lockout
+        now = time.monotonic()
+        for username, (count, last) in list(self._failures.items()):
+            if now - last >= self.lockout_seconds:
+                del self._failures[username]
+
+    def _check_pid(self):
+        # called with the lock held before any state is used.  a forked
+        # worker drops the state it inherited and starts its own flush thread
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            self._pending = {}
+            self._failures = {}
+            self._dropped = 0
+            self._flush_failures = 0
+        self._pid = os.getpid()
+        if self._stopping.is_set():
+            return
+        self._thread = threading.Thread(target=self._run, name='login-event-flush')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+def normalize_username(username):
+    """
+    Key for failure streaks, so case and whitespace variants share one
+    :param username: str
+    :return: str
+    """
+    return (username or '').strip().lower()